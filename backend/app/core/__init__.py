@@ -1 +1,17 @@
- 
\ No newline at end of file
+import os
+
+
+def _worker_count() -> int:
+    """Number of server worker processes, from WEB_CONCURRENCY (as used by uvicorn/gunicorn)."""
+    value = os.environ.get("WEB_CONCURRENCY", "1")
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"Ignoring invalid WEB_CONCURRENCY={value!r}, assuming a single worker.")
+        return 1
+
+
+# OpenCV, torch (OpenMP) and Numba each parallelize over all cores by default. With several server
+# workers that oversubscribes the CPU, so each worker bounds its thread pools to its share of the cores.
+WORKERS = _worker_count()
+NUM_THREADS = max(1, (os.cpu_count() or 1) // WORKERS)
@@ -1,15 +1,17 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles # Import StaticFiles
 import shutil
 import os
-import numpy as np # For handling mask data
+import re
+import tempfile
+import aiofiles # For non-blocking, chunked writes of uploads
 from pydantic import BaseModel # For request body validation
-from typing import List, Any # Any for the raw mask data for now
-import cv2
+from typing import List, Optional
 
 # Import the SAM service and its loader
-from .services.segmentation_service import load_sam_model, get_image_segmentation_masks, SAM_CHECKPOINT_PATH, MODEL_TYPE, DEVICE, SAM_PREDICTOR
+from .services.segmentation_service import load_sam_model, is_sam_loaded, get_image_segmentation_masks, get_cached_mask, SAM_CHECKPOINT_PATH, MODEL_TYPE, DEVICE
 from .services.recoloring_service import recolor_segment_hsv, hex_to_hsl # Added recoloring service
 
 # Define the origins that should be allowed to make cross-origin requests.
@@ -22,6 +24,28 @@ origins = [
 
 app = FastAPI(title="Gunpla Colorizer API")
 
+# Largest accepted upload. Bigger requests are rejected before their body is read.
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+UPLOAD_TOO_LARGE_DETAIL = f"Upload too large. The maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)}MB."
+# Content types accepted by /upload-image/ (the actual format is still checked from the file's magic bytes)
+ALLOWED_UPLOAD_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp", "image/bmp", "image/tiff"}
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """
+    Rejects oversized uploads from their Content-Length header alone.
+    This has to be a middleware: by the time the endpoint runs, FastAPI has already parsed
+    (and spooled to disk) the whole multipart body. Registered before CORSMiddleware so the
+    413 response still carries CORS headers for the frontend.
+    """
+    if request.url.path == "/upload-image/":
+        content_length = request.headers.get("content-length", "0")
+        if not content_length.isdigit():
+            return JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+        if int(content_length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(status_code=413, content={"detail": UPLOAD_TOO_LARGE_DETAIL})
+    return await call_next(request)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -35,8 +59,54 @@ UPLOAD_DIR = "./uploaded_images"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
+# Uploads are streamed to disk in 64KB chunks
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Leading bytes of the image formats we accept, and the extensions each may be saved under.
+# All of them are read directly by cv2.imread, so uploads are stored as-is without re-encoding.
+IMAGE_FORMATS = [
+    # (magic bytes at offset 0, magic bytes at offset 8 or None, allowed extensions)
+    (b"\xff\xd8\xff", None, (".jpg", ".jpeg")),
+    (b"\x89PNG\r\n\x1a\n", None, (".png",)),
+    (b"RIFF", b"WEBP", (".webp",)),
+    (b"BM", None, (".bmp",)),
+    (b"II*\x00", None, (".tif", ".tiff")),
+    (b"MM\x00*", None, (".tif", ".tiff")),
+]
+
+def sniff_image_extensions(header: bytes):
+    """Returns the allowed file extensions for the image format in `header` (first 12+ bytes), or None."""
+    for magic, magic_at_8, extensions in IMAGE_FORMATS:
+        if header.startswith(magic) and (magic_at_8 is None or header[8:12] == magic_at_8):
+            return extensions
+    return None
+
+# Target colors accepted by /recolor-image/ (without the leading '#')
+HEX_COLOR_RE = re.compile(r"[0-9a-fA-F]{6}")
+# Recolor results are written to their own directory, never mixed with uploads, as
+# "<upload filename>_<hex>.png". Keeping the upload's extension in the name keeps e.g. "rx78.jpg"
+# and "rx78.png" apart, and each result name maps back to exactly one upload.
+RECOLOR_DIR = "./recolored_images"
+if not os.path.exists(RECOLOR_DIR):
+    os.makedirs(RECOLOR_DIR)
+
+def recolor_result_name_re(image_name: str):
+    """Returns a regex matching the names of recolor results of the upload `image_name`."""
+    return re.compile(re.escape(image_name) + r"_[0-9a-f]{6}\.png")
+
+def remove_stale_recolors(image_name: str, keep_path: str):
+    """Deletes earlier recolor results of the upload `image_name`, except `keep_path` (the latest one)."""
+    result_name_re = recolor_result_name_re(image_name)
+    for name in os.listdir(RECOLOR_DIR):
+        path = os.path.join(RECOLOR_DIR, name)
+        if result_name_re.fullmatch(name) and path != keep_path:
+            try:
+                os.remove(path)
+            except OSError: # Already removed, or still open elsewhere; a later recolor retries
+                pass
+
 # Mount static files directory
 app.mount("/uploaded_images", StaticFiles(directory=UPLOAD_DIR), name="uploaded_images")
+app.mount("/recolored_images", StaticFiles(directory=RECOLOR_DIR), name="recolored_images")
 
 # --- Pydantic Models for API --- 
 class PointPrompt(BaseModel):
@@ -46,11 +116,12 @@ class PointPrompt(BaseModel):
 
 class SegmentationRequest(BaseModel):
     image_name: str # Filename of the uploaded image
-    prompts: List[PointPrompt]
+    prompts: List[List[PointPrompt]] # One list of point prompts per object to segment
 
 class RecolorRequest(BaseModel):
-    image_name: str
-    mask: List[List[bool]] # Expecting a 2D boolean array for the mask
+    image_name: str # Filename of the uploaded image
+    recolored_image_name: Optional[str] = None # Latest recolor result of that image to build on, if any
+    mask_id: str # Id of a mask returned by /segment-image/
     target_hex_color: str
 
 # --- Application Startup Event ---
@@ -61,13 +132,14 @@ async def startup_event():
     print(f"Expected SAM checkpoint: {SAM_CHECKPOINT_PATH}")
     print(f"SAM model type: {MODEL_TYPE}")
     print(f"Target device: {DEVICE}")
+    # Let loading errors propagate: without a model, uvicorn should not start serving at all
     load_sam_model() # Load the SAM model into memory
-    print("SAM initialization attempt complete.")
+    print("SAM initialization complete.")
 
 @app.get("/")
 async def read_root():
     """Root endpoint to check if the API is running."""
-    return {"message": "Welcome to the Gunpla Colorizer API!", "sam_model_loaded": SAM_PREDICTOR is not None}
+    return {"message": "Welcome to the Gunpla Colorizer API!", "sam_model_loaded": is_sam_loaded()}
 
 @app.post("/upload-image/")
 async def upload_image(file: UploadFile = File(...)):
@@ -82,43 +154,76 @@ async def upload_image(file: UploadFile = File(...)):
     if not original_filename: 
         raise HTTPException(status_code=400, detail="Invalid original filename.")
 
-    # Create a new filename with .png extension
-    filename_stem = os.path.splitext(original_filename)[0]
-    new_png_filename = f"{filename_stem}.png"
-    
-    file_location = os.path.join(UPLOAD_DIR, new_png_filename)
+    if file.content_type not in ALLOWED_UPLOAD_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail=f"Unsupported content type '{file.content_type}'. Please upload a JPEG, PNG, WEBP, BMP or TIFF image.")
 
+    tmp_location = None
     try:
-        # Read the uploaded file in-memory
-        contents = await file.read()
-        img_array = np.frombuffer(contents, np.uint8)
-        img_bgr = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        # Validate the format from the magic bytes of the first chunk before touching disk
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            raise HTTPException(status_code=400, detail=f"Uploaded file '{original_filename}' is empty.")
+        allowed_extensions = sniff_image_extensions(chunk[:12])
+        if allowed_extensions is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported image format: {original_filename}. Please upload a JPEG, PNG, WEBP, BMP or TIFF image.")
 
-        if img_bgr is None:
-            raise HTTPException(status_code=400, detail=f"Could not decode image file: {original_filename}. Ensure it is a valid image format.")
+        # Keep the original filename and extension; OpenCV and SAM read these formats directly,
+        # so there is no need to re-encode the upload. Only a missing or wrong extension is
+        # replaced, so the file is served with a Content-Type matching its actual format.
+        image_name = original_filename
+        filename_stem, extension = os.path.splitext(original_filename)
+        if extension.lower() not in allowed_extensions:
+            image_name = f"{filename_stem}{allowed_extensions[0]}"
+        file_location = os.path.join(UPLOAD_DIR, image_name)
 
-        # Save the image as PNG
-        cv2.imwrite(file_location, img_bgr)
-        
-        return {"info": f"File '{original_filename}' processed and saved as '{new_png_filename}'", "image_name": new_png_filename}
+        # Stream the upload to disk in chunks so peak memory stays at one chunk
+        # regardless of the file size. The size is enforced here too, since Content-Length
+        # may be missing (chunked transfer) or may not match the body.
+        # Write to a temporary file and only move it into place once complete, so a failed or
+        # oversized re-upload doesn't destroy an existing image of the same name.
+        fd, tmp_location = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".tmp")
+        os.close(fd)
+        bytes_written = 0
+        async with aiofiles.open(tmp_location, "wb") as out_file:
+            while chunk:
+                bytes_written += len(chunk)
+                if bytes_written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+                await out_file.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        os.replace(tmp_location, file_location)
+        tmp_location = None
+
+        return {"info": f"File '{original_filename}' saved as '{image_name}'", "image_name": image_name}
     except HTTPException as http_exc: # Re-raise HTTPExceptions directly
         raise http_exc
     except Exception as e:
-        print(f"Error processing/saving uploaded file {original_filename} as PNG: {e}")
-        raise HTTPException(status_code=500, detail=f"Could not process/save file as PNG: {e}")
+        print(f"Error saving uploaded file {original_filename}: {e}")
+        raise HTTPException(status_code=500, detail=f"Could not save file: {e}")
+    finally:
+        if tmp_location and os.path.exists(tmp_location):
+            os.remove(tmp_location) # Don't leave a partially written upload behind
 
 @app.post("/segment-image/")
 async def segment_image_endpoint(request: SegmentationRequest):
     """
     Endpoint to segment an image based on point prompts.
-    Expects the image to have been uploaded previously.
+    Each entry of `prompts` describes one object; the best mask for each object is returned,
+    in the same order. Expects the image to have been uploaded previously.
     """
+    # Check the model before doing any disk or decode work for the request
+    if not is_sam_loaded():
+        raise HTTPException(status_code=503, detail="SAM model is not loaded.")
+
     image_path = os.path.join(UPLOAD_DIR, request.image_name)
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail=f"Image '{request.image_name}' not found in upload directory.")
 
-    point_coords = [[p.x, p.y] for p in request.prompts]
-    point_labels = [p.label for p in request.prompts]
+    if not request.prompts or any(not prompt_set for prompt_set in request.prompts):
+        raise HTTPException(status_code=400, detail="Each object needs at least one point prompt.")
+
+    point_coords = [[[p.x, p.y] for p in prompt_set] for prompt_set in request.prompts]
+    point_labels = [[p.label for p in prompt_set] for prompt_set in request.prompts]
 
     print(f"Received segmentation request for {request.image_name} with points: {point_coords}, labels: {point_labels}")
 
@@ -137,21 +242,48 @@ async def segment_image_endpoint(request: SegmentationRequest):
 
 @app.post("/recolor-image/")
 async def recolor_image_endpoint(request: RecolorRequest):
-    image_path = os.path.join(UPLOAD_DIR, request.image_name)
+    # Sanitize filename to prevent directory traversal issues, as for uploads
+    image_name = os.path.basename(request.image_name)
+    image_path = os.path.join(UPLOAD_DIR, image_name)
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail=f"Image '{request.image_name}' not found for recoloring.")
 
+    # Recolors build on each other: start from the latest result if the client has one.
+    # It must be a result of this upload, which also keeps it inside RECOLOR_DIR.
+    source_path = image_path
+    if request.recolored_image_name:
+        if not recolor_result_name_re(image_name).fullmatch(request.recolored_image_name):
+            raise HTTPException(status_code=400, detail=f"'{request.recolored_image_name}' is not a recolored version of '{image_name}'.")
+        source_path = os.path.join(RECOLOR_DIR, request.recolored_image_name)
+        if not os.path.exists(source_path):
+            raise HTTPException(status_code=404, detail=f"Recolored image '{request.recolored_image_name}' not found. Please recolor the original again.")
+
+    # The hex color ends up in the output filename, so only accept plain 6-digit hex colors
+    hex_digits = request.target_hex_color.lstrip('#')
+    if not HEX_COLOR_RE.fullmatch(hex_digits):
+        raise HTTPException(status_code=400, detail=f"Invalid hex color '{request.target_hex_color}'. Expected a value like '#FF0000'.")
+
+    # Look up the mask produced by /segment-image/ instead of receiving it in the request body
+    mask_np = get_cached_mask(request.mask_id)
+    if mask_np is None:
+        raise HTTPException(status_code=404, detail=f"Mask '{request.mask_id}' not found or expired. Please generate the mask again.")
+
     try:
-        # Convert the received list of lists of booleans mask to a NumPy array
-        mask_np = np.array(request.mask, dtype=bool)
-        
-        print(f"Recoloring image: {request.image_name} with color {request.target_hex_color}")
-        # The recolor_segment_hsv function overwrites the image and returns its path.
-        modified_image_path = recolor_segment_hsv(image_path, mask_np, request.target_hex_color)
+        # Name the output after the original upload, so names don't grow with every pick;
+        # the upload itself is left untouched.
+        out_path = os.path.join(RECOLOR_DIR, f"{image_name}_{hex_digits.lower()}.png")
+
+        print(f"Recoloring image: {os.path.basename(source_path)} with color {request.target_hex_color}")
+        # The recolor_segment_hsv function writes the recolored image to out_path and returns it,
+        # or returns source_path if there was nothing to change.
+        modified_image_path = recolor_segment_hsv(source_path, mask_np, request.target_hex_color, out_path)
+        # Only the latest result is shown by the client, so drop the ones it replaces
+        remove_stale_recolors(image_name, modified_image_path)
         
         return {
             "message": "Image segment recolored successfully.", 
-            "recolored_image_name": os.path.basename(modified_image_path),
+            # None if the upload itself was returned unchanged (there is no result to show yet)
+            "recolored_image_name": os.path.basename(modified_image_path) if modified_image_path != image_path else None,
             "new_color_applied": request.target_hex_color
         }
     except FileNotFoundError as e:
@@ -1,94 +1,256 @@
 import cv2
 import numpy as np
 import os
+import hashlib
+import shutil
+import tempfile
+
+from ..core import NUM_THREADS
+
+# OpenCV parallelizes cvtColor and image encoding over all cores by default; keep it to this worker's share
+cv2.setNumThreads(NUM_THREADS)
+
+# Numba is optional: when it's installed, masked pixels are recolored by a compiled per-pixel
+# kernel (a starting point for per-pixel logic that doesn't vectorize well, e.g. hue shifts or
+# local contrast preservation). Otherwise the NumPy gather/scatter path is used.
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+if numba is not None:
+    numba.set_num_threads(min(NUM_THREADS, numba.config.NUMBA_NUM_THREADS))
+
+    @njit(parallel=True, cache=True)
+    def _recolor_kernel(img_bgr, mask, bgr_lut):
+        """In place, replaces each masked BGR pixel by bgr_lut[V], where V = max(B, G, R) as in OpenCV's HSV."""
+        for r in prange(img_bgr.shape[0]):
+            for c in range(img_bgr.shape[1]):
+                if mask[r, c]:
+                    v = max(img_bgr[r, c, 0], img_bgr[r, c, 1], img_bgr[r, c, 2])
+                    img_bgr[r, c, 0] = bgr_lut[v, 0]
+                    img_bgr[r, c, 1] = bgr_lut[v, 1]
+                    img_bgr[r, c, 2] = bgr_lut[v, 2]
+
+    # Compile (or load from numba's cache) now rather than on the first recolor request
+    _recolor_kernel(np.zeros((1, 1, 3), dtype=np.uint8), np.ones((1, 1), dtype=np.bool_), np.zeros((256, 3), dtype=np.uint8))
+
+# Fixed-point precision OpenCV uses for 8-bit BGR -> HSV conversion
+_HSV_SHIFT = 12
 
 def hex_to_hsl(hex_color: str):
-    """Converts a hex color string to HSL values (H: 0-179, S: 0-255, L: 0-255 for OpenCV)."""
+    """
+    Converts a hex color string to HSV values (H: 0-179, S: 0-255, V: 0-255 for OpenCV).
+    Despite the name, V (Value) is what we treat as L (Lightness) for preservation.
+
+    Uses the same fixed-point arithmetic as cv2.cvtColor(..., cv2.COLOR_BGR2HSV) on 8-bit
+    images, so the result matches OpenCV exactly without building a 1x1 image to convert.
+    """
     hex_color = hex_color.lstrip('#')
     h_len = len(hex_color)
-    rgb = tuple(int(hex_color[i:i + h_len // 3], 16) for i in range(0, h_len, h_len // 3))
-    
-    # Convert RGB to a BGR numpy array (OpenCV format for color conversion)
-    # Note: OpenCV expects a 3D array for cvtColor, so we create a 1x1 pixel image
-    bgr_color = np.uint8([[rgb[::-1]]]) # RGB to BGR
-    
-    hsv_color = cv2.cvtColor(bgr_color, cv2.COLOR_BGR2HSV_FULL) # Using HSV_FULL for H range 0-255
-    # For HSL (actually HLS in OpenCV)
-    # hsl_color = cv2.cvtColor(bgr_color, cv2.COLOR_BGR2HLS_FULL)
-    # HLS_FULL: H (0-255), L (0-255), S (0-255)
-    # For consistency with common understanding of HSL, and because HSV is often better for this:
-    # We will use HSV and treat V (Value) as L (Lightness) for preservation.
-    # H (0-179 or 0-255), S (0-255), V (0-255)
-    # Using HSV_FULL to get H in 0-255 range if desired, but OpenCV's default HSV H is 0-179.
-    # Let's stick to OpenCV's default HSV (H range 0-179) for simplicity first.
-    
-    hsv_pixel = cv2.cvtColor(bgr_color, cv2.COLOR_BGR2HSV)
-    return hsv_pixel[0][0] # H, S, V
+    r, g, b = (int(hex_color[i:i + h_len // 3], 16) for i in range(0, h_len, h_len // 3))
+
+    v = max(r, g, b)
+    diff = v - min(r, g, b)
+    half = 1 << (_HSV_SHIFT - 1)
+
+    # S = 255 * diff / V
+    sdiv = round((255 << _HSV_SHIFT) / v) if v else 0
+    s = (diff * sdiv + half) >> _HSV_SHIFT
+
+    # H in degrees / 2, so that it fits 0-179
+    if v == r:
+        h = g - b
+    elif v == g:
+        h = b - r + 2 * diff
+    else:
+        h = r - g + 4 * diff
+    hdiv = round((180 << _HSV_SHIFT) / (6 * diff)) if diff else 0
+    h = (h * hdiv + half) >> _HSV_SHIFT
+    if h < 0:
+        h += 180
+
+    return h, s, v
+
+
+# --- Recolor Result Cache ---
+# Users iterate over colors, so the same (image, mask, color) is often recolored again within
+# seconds. Results are kept on disk keyed by the content of all three, turning a repeat into a
+# file copy. The directory is bounded in size, evicting the least recently used files (by mtime).
+RECOLOR_CACHE_DIR = "./recolor_cache"
+RECOLOR_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+def _recolor_cache_path(image_bytes: bytes, mask: np.ndarray, target_hex_color: str, extension: str) -> str:
+    """Returns the cache file path for recoloring `mask` of the encoded image `image_bytes` with a color."""
+    image_hash = hashlib.sha1(image_bytes).hexdigest()[:16]
+    mask_hash = hashlib.sha1(np.packbits(mask, axis=None).tobytes() + str(mask.shape).encode()).hexdigest()[:16]
+    return os.path.join(RECOLOR_CACHE_DIR, f"{image_hash}{mask_hash}{target_hex_color.lstrip('#').lower()}{extension}")
+
+def _copy_from_recolor_cache(cache_path: str, out_path: str) -> bool:
+    """Copies a cached result to out_path. Returns False on a cache miss."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(out_path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(cache_path, tmp_path)
+        os.utime(cache_path) # Mark as recently used for eviction
+    except OSError: # Not cached, or evicted in the meantime
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, out_path)
+    return True
 
+def _store_in_recolor_cache(cache_path: str, encoded_img: bytes):
+    """Adds a result to the cache, then evicts least recently used files beyond RECOLOR_CACHE_MAX_BYTES."""
+    os.makedirs(RECOLOR_CACHE_DIR, exist_ok=True)
+    _write_atomic(cache_path, encoded_img)
 
-def recolor_segment_hsv(image_path: str, mask: np.ndarray, target_hex_color: str) -> str:
+    entries = []
+    for entry in os.scandir(RECOLOR_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".tmp"): # Skip other writers' files in flight
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= RECOLOR_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
+
+def _write_atomic(path: str, data: bytes):
+    """Writes to a temporary file first and then moves it into place, so readers never see a partial file."""
+    # A unique temporary name, so concurrent writers of the same path don't clobber each other's file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# A segment counts as already having the target color when its mean H and S differences from the
+# target are within these tolerances (H is 0-179, S is 0-255; S is noisier in darker pixels).
+# Hue is only compared over pixels with S and V of at least SAME_COLOR_MIN_SV: it is noise in
+# near-gray and near-black pixels, and OpenCV gives V = 0 pixels S = 0. Unless such pixels make up
+# at least SAME_COLOR_MIN_RELIABLE_SHARE of the mask, saturation is compared over the whole mask
+# instead, so e.g. white armor with a matching red trim still counts as white.
+SAME_COLOR_HUE_TOLERANCE = 3
+SAME_COLOR_SAT_TOLERANCE = 8
+SAME_COLOR_MIN_SV = 32
+SAME_COLOR_MIN_RELIABLE_SHARE = 0.9
+
+def _is_already_colored(masked_hsv: np.ndarray, target_h: int, target_s: int) -> bool:
+    """Whether an N x 3 HSV strip already has the target H and S on average (see SAME_COLOR_HUE_TOLERANCE)."""
+    reliable = (masked_hsv[:, 1] >= SAME_COLOR_MIN_SV) & (masked_hsv[:, 2] >= SAME_COLOR_MIN_SV)
+    if reliable.mean() < SAME_COLOR_MIN_RELIABLE_SHARE:
+        # Largely gray, white or black: only the overall saturation tells whether it matches
+        sat_diff = np.abs(masked_hsv[:, 1].astype(np.int16) - target_s)
+        return sat_diff.mean() <= SAME_COLOR_SAT_TOLERANCE
+    # Hue is circular (0-179), so 179 and 0 are only 1 apart
+    hue_diff = np.abs(masked_hsv[reliable, 0].astype(np.int16) - target_h)
+    hue_diff = np.minimum(hue_diff, 180 - hue_diff)
+    sat_diff = np.abs(masked_hsv[reliable, 1].astype(np.int16) - target_s)
+    return hue_diff.mean() <= SAME_COLOR_HUE_TOLERANCE and sat_diff.mean() <= SAME_COLOR_SAT_TOLERANCE
+
+def recolor_segment_hsv(image_path: str, mask: np.ndarray, target_hex_color: str, out_path: str) -> str:
     """
     Recolors the specified segment of an image using HSV color space manipulation.
     The original Value (brightness) is preserved to maintain texture and lighting.
 
     Args:
-        image_path (str): Path to the original image.
+        image_path (str): Path to the original image. It is left untouched.
         mask (np.ndarray): A 2D boolean numpy array where True indicates the segment to recolor.
                            It must have the same height and width as the image.
         target_hex_color (str): The target color in hex format (e.g., "#FF0000").
+        out_path (str): Path to write the recolored image to. The format is taken from its extension.
 
     Returns:
-        str: Path to the modified (recolored) image. Overwrites the original image.
+        str: Path to the modified (recolored) image, i.e. out_path. If the mask is empty or the
+             segment already has the target color, nothing is written and image_path is returned.
     """
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"Image not found at {image_path}")
 
-    img_bgr = cv2.imread(image_path)
+    # Read the file once: its bytes are both hashed for the result cache and decoded
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    if mask.dtype != bool:
+        mask = mask.astype(bool) # Ensure it's boolean
+
+    # Nothing to recolor (e.g. the client sent an empty selection): keep the image as it is
+    if not mask.any():
+        print(f"Empty mask for {image_path}, nothing to recolor.")
+        return image_path
+
+    # Same image, mask and color as an earlier request: reuse its result without decoding the image.
+    # The key includes the mask shape, and only results of masks matching the image are stored.
+    out_extension = os.path.splitext(out_path)[1] or ".png"
+    cache_path = _recolor_cache_path(image_bytes, mask, target_hex_color, out_extension)
+    if _copy_from_recolor_cache(cache_path, out_path):
+        print(f"Image {image_path} recolored with {target_hex_color} from cache, saved to {out_path}.")
+        return out_path
+
+    img_bgr = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
     if img_bgr is None:
         raise ValueError(f"Could not read image from {image_path}")
 
-    # Ensure mask is a boolean array of the same H, W dimensions as the image
+    # Ensure mask has the same H, W dimensions as the image
     if mask.shape[0] != img_bgr.shape[0] or mask.shape[1] != img_bgr.shape[1]:
         raise ValueError("Mask dimensions do not match image dimensions.")
-    if mask.dtype != bool:
-        mask = mask.astype(bool) # Ensure it's boolean
-
-    # Convert the original image to HSV
-    img_hsv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2HSV)
 
     # Get target H, S, V values from the hex color
     # We will use the H and S from the target color, and V from the original image.
     target_h, target_s, _ = hex_to_hsl(target_hex_color) # We get H,S,V but only use H,S
 
-    # Iterate over each pixel
-    # This can be slow for large images/masks. Vectorized operations are faster.
-    # For pixels where the mask is True, change their H and S values.
-    
-    # Get all coordinates where mask is True
-    row_indices, col_indices = np.where(mask)
+    # Only the masked pixels need to go through HSV, so convert them as an N x 3 strip
+    # rather than the whole image. Unmasked pixels are left byte-identical.
+    masked_hsv = cv2.cvtColor(img_bgr[mask].reshape(-1, 1, 3), cv2.COLOR_BGR2HSV).reshape(-1, 3)
 
-    # Modify H, S, V values for the masked region
-    # img_hsv[mask] would give a flattened array of HSV pixels.
-    # We need to modify them in place or construct a new HSV array.
-    
-    for r, c in zip(row_indices, col_indices):
-        # original_h, original_s, original_v = img_hsv[r, c]
-        img_hsv[r, c][0] = target_h  # Set Hue to target Hue
-        img_hsv[r, c][1] = target_s  # Set Saturation to target Saturation
-        # img_hsv[r, c][2] remains original_v (Value/Lightness)
-
-    # Convert the modified HSV image back to BGR
-    recolored_img_bgr = cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR)
-
-    # Overwrite the original image file
-    # In a more complex app, you might save to a new file or manage versions.
-    cv2.imwrite(image_path, recolored_img_bgr)
-    
-    print(f"Image {image_path} recolored with {target_hex_color} for the given mask.")
-    return image_path
+    # If the segment already has the target hue and saturation (e.g. the same color was picked
+    # again), recoloring would not visibly change anything, so skip the conversion and the write.
+    if _is_already_colored(masked_hsv, target_h, target_s):
+        print(f"Segment of {image_path} already has color {target_hex_color}, nothing to recolor.")
+        return image_path
+
+    # With H and S fixed, the output BGR of a masked pixel depends only on its V.
+    # Build a 256-entry V -> BGR lookup table once and gather from it, instead of
+    # converting every masked pixel back from HSV.
+    hsv_lut = np.stack([
+        np.full(256, target_h, dtype=np.uint8),  # Target Hue
+        np.full(256, target_s, dtype=np.uint8),  # Target Saturation
+        np.arange(256, dtype=np.uint8),          # Every possible V (Value/Lightness)
+    ], axis=-1).reshape(256, 1, 3)
+    bgr_lut = cv2.cvtColor(hsv_lut, cv2.COLOR_HSV2BGR).reshape(256, 3)
+
+    # Look up the recolored BGR for each masked pixel and write it into the image
+    recolored_img_bgr = img_bgr
+    if numba is not None:
+        _recolor_kernel(recolored_img_bgr, mask, bgr_lut)
+    else:
+        recolored_img_bgr[mask] = bgr_lut[masked_hsv[:, 2]]
+
+    # Write to a new file so the original stays pristine for further edits, atomically so
+    # readers never see a partial file. Keep a copy in the result cache for repeats.
+    ok, encoded_img = cv2.imencode(out_extension, recolored_img_bgr)
+    if not ok:
+        raise ValueError(f"Could not encode recolored image for {out_path}")
+    _write_atomic(out_path, encoded_img.tobytes())
+    try:
+        _store_in_recolor_cache(cache_path, encoded_img.tobytes())
+    except OSError as e: # The result is already written; a cache failure shouldn't fail the request
+        print(f"Could not store recolor result in cache at {cache_path}: {e}")
+
+    print(f"Image {image_path} recolored with {target_hex_color} for the given mask, saved to {out_path}.")
+    return out_path
 
 if __name__ == '__main__':
     # Example Usage (for testing this file directly)
+    # It imports app.core, so run it as a module from the 'backend' directory:
+    # python -m app.services.recoloring_service
     print("Testing recoloring service...")
     # Create a dummy image and mask for testing
     dummy_image_path = os.path.join(os.path.dirname(__file__), "..", "..", "uploaded_images", "test_recolor.png")
@@ -109,7 +271,7 @@ if __name__ == '__main__':
 
     try:
         print(f"Applying color {target_color_hex} to masked region of {dummy_image_path}...")
-        recolored_path = recolor_segment_hsv(dummy_image_path, dummy_mask, target_color_hex)
+        recolored_path = recolor_segment_hsv(dummy_image_path, dummy_mask, target_color_hex, dummy_image_path.replace(".png", "_ff00ff.png"))
         print(f"Recoloring complete. Modified image saved at: {recolored_path}")
         
         # To verify, you'd open the image and check if the green square is now magenta
@@ -118,12 +280,20 @@ if __name__ == '__main__':
 
         # Test with a different color
         target_color_hex_blue = "#0000FF" # Blue
-        # Re-read the original for a clean test (or copy it before first recolor)
-        cv2.imwrite(dummy_image_path, test_img) # Restore original for next test
-        print(f"Restored original. Applying color {target_color_hex_blue}...")
-        recolored_path_blue = recolor_segment_hsv(dummy_image_path, dummy_mask, target_color_hex_blue)
+        # The original is left untouched, so it can be recolored again directly
+        print(f"Applying color {target_color_hex_blue} to the original...")
+        recolored_path_blue = recolor_segment_hsv(dummy_image_path, dummy_mask, target_color_hex_blue, dummy_image_path.replace(".png", "_0000ff.png"))
         print(f"Recoloring to blue complete: {recolored_path_blue}")
 
+        # A mostly white panel with a red trim is not "already red", even though its saturated pixels are
+        panel_img = np.full((100, 100, 3), 235, dtype=np.uint8)
+        panel_img[:10, :] = (0, 0, 200) # Red stripe (BGR)
+        panel_hsv = cv2.cvtColor(panel_img, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+        red_h, red_s, _ = hex_to_hsl("#c80000")
+        assert not _is_already_colored(panel_hsv, red_h, red_s), "White panel with a red trim was taken as already red"
+        assert _is_already_colored(panel_hsv[:1000], red_h, red_s), "Red stripe was not taken as already red"
+        print("Same-color check on a white panel with a red trim passed.")
+
     except Exception as e:
         print(f"Error during testing: {e}")
 
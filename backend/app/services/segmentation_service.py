@@ -1,58 +1,341 @@
+import os
+from ..core import NUM_THREADS
+# Bound torch's OpenMP thread pool to this server worker's share of the cores.
+# This has to happen before torch is imported to take effect; an explicit OMP_NUM_THREADS wins.
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+
 import numpy as np
 import torch
 import cv2 # OpenCV for image manipulation
 from segment_anything import sam_model_registry, SamPredictor
-import os
+import asyncio
+import base64
+import re
+import tempfile
+import time
+import uuid
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from PIL import Image # Pillow for image opening
 
 # --- Configuration ---
 # Determine the device to run the model on (GPU if available, otherwise CPU)
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
-# Define the SAM model type we are using
-MODEL_TYPE = "vit_l"
-# Path to the downloaded SAM checkpoint
-# Assumes the checkpoint is in a 'models_checkpoints' directory at the same level as the 'app' directory
-SAM_CHECKPOINT_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "models_checkpoints", "sam_vit_l_0b3195.pth")
+# Default checkpoint file name for each supported model type.
+# "vit_t" is MobileSAM, whose small TinyViT image encoder is much faster on CPU/MPS.
+DEFAULT_CHECKPOINTS = {
+    "vit_h": "sam_vit_h_4b8939.pth",
+    "vit_l": "sam_vit_l_0b3195.pth",
+    "vit_b": "sam_vit_b_01ec64.pth",
+    "vit_t": "mobile_sam.pt",
+}
+# Define the SAM model type we are using (override with the SAM_MODEL_TYPE environment variable)
+MODEL_TYPE = os.environ.get("SAM_MODEL_TYPE", "vit_l")
+# Path to the downloaded SAM checkpoint (override with the SAM_CHECKPOINT_PATH environment variable)
+# Defaults to the model type's checkpoint in a 'models_checkpoints' directory at the same level as the 'app' directory
+SAM_CHECKPOINT_PATH = os.environ.get(
+    "SAM_CHECKPOINT_PATH",
+    os.path.join(os.path.dirname(__file__), "..", "..", "models_checkpoints", DEFAULT_CHECKPOINTS.get(MODEL_TYPE, f"sam_{MODEL_TYPE}.pth")),
+)
+def _probe_autocast_dtype():
+    """Picks the reduced precision for the image encoder: FP16 on CUDA; on MPS, BF16 if this
+    torch/macOS supports it under autocast, else FP16, else none. Returns None for FP32."""
+    if DEVICE.type == "cuda":
+        return torch.float16
+    if DEVICE.type != "mps":
+        return None
+    for dtype in (torch.bfloat16, torch.float16):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error") # autocast warns and disables itself for unsupported dtypes
+                with torch.autocast(device_type="mps", dtype=dtype):
+                    x = torch.ones(2, 2, device=DEVICE)
+                    if (x @ x).dtype == dtype:
+                        return dtype
+        except Exception as e:
+            print(f"Autocast with {dtype} is not available on MPS: {e}")
+    return None
+
+# Reduced precision used for the image encoder forward pass (see _probe_autocast_dtype).
+# On CPU the encoder stays in FP32. The prompt encoder and mask decoder always run in FP32.
+ENCODER_DTYPE = _probe_autocast_dtype()
+# Compile the image encoder with torch.compile at startup (requires torch>=2.1).
+# Set SAM_TORCH_COMPILE=0 to skip it, e.g. for faster reloads during development (see README "Running the Backend").
+TORCH_COMPILE = os.environ.get("SAM_TORCH_COMPILE", "1") != "0"
 
 # --- Global SAM Predictor --- 
 # Initialize SAM predictor as a global variable to load the model only once.
 # This is a common practice for heavy models in web services to avoid reloading on every request.
 SAM_PREDICTOR = None
+# All SAM work runs on this single thread. SamPredictor keeps the current image as state and is
+# not reentrant, and the compiled encoder's CUDA graphs (torch.compile "reduce-overhead") are
+# thread-local, so they would be re-recorded on every new thread of a shared pool.
+_SAM_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sam")
+
+# --- Image Embedding Cache ---
+# The image encoder is by far the most expensive part of SAM, while the frontend sends many
+# prompt updates for the same image. Embeddings are cached per (image_path, mtime) so that
+# every click after the first only runs the lightweight prompt encoder and mask decoder.
+# Kept small and LRU-evicted since each entry holds the features on DEVICE.
+EMBED_CACHE_SIZE = 8
+_EMBED_CACHE = OrderedDict() # (abs image path, mtime) -> (features, original_size, input_size)
+
+# --- Mask Cache ---
+# Masks returned by /segment-image/ are kept server-side under a random id, so /recolor-image/
+# can reference a mask by id instead of the client sending the full mask back.
+# They live on disk rather than in memory so that with several server workers (WEB_CONCURRENCY)
+# a recolor request finds the mask whichever worker produced it. Masks are stored bit-packed
+# (1 bit per pixel), expire MASK_CACHE_TTL_SECONDS after creation, and beyond MASK_CACHE_SIZE
+# entries the oldest are evicted.
+MASK_CACHE_DIR = "./mask_cache"
+MASK_CACHE_SIZE = 256
+MASK_CACHE_TTL_SECONDS = 60 * 60
+_MASK_ID_RE = re.compile(r"[0-9a-f]{32}") # uuid4().hex, also keeps ids from escaping MASK_CACHE_DIR
 
 def load_sam_model():
-    """Loads the SAM model into the global SAM_PREDICTOR variable."""
+    """
+    Loads the SAM model into the global SAM_PREDICTOR variable.
+    Raises FileNotFoundError if the checkpoint is missing, and re-raises any loading error.
+
+    The released checkpoints are FP32. No separate half-precision checkpoint is needed: on CUDA
+    the image encoder weights are converted to FP16 here after loading, and set_image runs under
+    autocast with ENCODER_DTYPE (see _encoder_autocast). The prompt encoder and mask decoder are
+    left in FP32 to preserve mask quality.
+    """
     global SAM_PREDICTOR
     if SAM_PREDICTOR is None:
         print(f"Attempting to load SAM model checkpoint from: {SAM_CHECKPOINT_PATH}")
         if not os.path.exists(SAM_CHECKPOINT_PATH):
             error_msg = f"SAM checkpoint not found at {SAM_CHECKPOINT_PATH}. Please download it first."
             print(f"ERROR: {error_msg}")
-            # In a real app, you might raise an exception or handle this more gracefully
-            # For now, we'll let it try to load and fail if the path is incorrect.
-            # raise FileNotFoundError(error_msg)
-        
+            # Fail fast instead of letting torch fail on the missing file further down
+            raise FileNotFoundError(error_msg)
+
         print(f"Loading SAM model ({MODEL_TYPE}) to {DEVICE}...")
         try:
-            sam_model = sam_model_registry[MODEL_TYPE](checkpoint=SAM_CHECKPOINT_PATH)
+            if MODEL_TYPE == "vit_t":
+                # MobileSAM is an optional dependency with the same registry/predictor interface
+                from mobile_sam import sam_model_registry as model_registry, SamPredictor as predictor_class
+            else:
+                model_registry, predictor_class = sam_model_registry, SamPredictor
+            sam_model = model_registry[MODEL_TYPE](checkpoint=SAM_CHECKPOINT_PATH)
             sam_model.to(device=DEVICE)
-            SAM_PREDICTOR = SamPredictor(sam_model)
+            if DEVICE.type == "cuda":
+                sam_model.image_encoder.half()
+            # NHWC layout gives the encoder's conv kernels tensor-core friendly memory access
+            sam_model.image_encoder = sam_model.image_encoder.to(memory_format=torch.channels_last)
+            SAM_PREDICTOR = predictor_class(sam_model)
+            if TORCH_COMPILE:
+                # Compile and warm up on the thread that will serve requests
+                _SAM_EXECUTOR.submit(_compile_image_encoder, SAM_PREDICTOR).result()
             print("SAM model loaded successfully.")
         except Exception as e:
             print(f"Error loading SAM model: {e}")
-            # SAM_PREDICTOR will remain None, and subsequent calls will fail
-            # Consider how to handle this in a production environment (e.g. app can't start)
+            # Re-raise so the app refuses to start rather than serving without a model
+            raise
 
-async def get_image_segmentation_masks(image_path: str, point_coords: list[list[float]], point_labels: list[int]):
+def is_sam_loaded() -> bool:
+    """
+    Returns whether the SAM model has been loaded.
+    Use this rather than importing SAM_PREDICTOR directly: load_sam_model rebinds the global,
+    so an imported name would stay the None it was at import time.
     """
-    Generates segmentation masks for an image given point prompts.
+    return SAM_PREDICTOR is not None
+
+def _compile_image_encoder(predictor):
+    """
+    Replaces the predictor's image encoder with a torch.compile'd version and warms it up.
+    Must run on _SAM_EXECUTOR, like every other call into the predictor.
+
+    SAM always resizes and pads its input to a fixed square size, so the encoder sees one static
+    shape and the compile cost is paid once here instead of on the first request. The warm-up goes
+    through set_image on a blank image, under the same modes as _run_sam, so that it hits exactly
+    the graph (input layout, dtype, grad mode) that requests will use. Falls back to the eager
+    encoder if torch is too old or compilation fails on this device.
+    """
+    if not hasattr(torch, "compile") or torch.__version__ < "2.1":
+        return
+    sam_model = predictor.model
+    eager_encoder = sam_model.image_encoder
+    try:
+        print("Compiling SAM image encoder with torch.compile...")
+        sam_model.image_encoder = torch.compile(eager_encoder, mode="reduce-overhead", dynamic=False)
+        img_size = getattr(eager_encoder, "img_size", 1024)
+        with torch.inference_mode(), _encoder_autocast():
+            predictor.set_image(np.zeros((img_size, img_size, 3), dtype=np.uint8))
+        predictor.reset_image()
+        print("SAM image encoder compiled.")
+    except Exception as e:
+        print(f"torch.compile is unavailable for the SAM image encoder, using eager mode: {e}")
+        sam_model.image_encoder = eager_encoder
+
+def _encoder_autocast():
+    """Returns the autocast context the image encoder should run under on DEVICE."""
+    if ENCODER_DTYPE is None:
+        return nullcontext()
+    return torch.autocast(device_type=DEVICE.type, dtype=ENCODER_DTYPE)
+
+def encode_mask(mask: np.ndarray) -> str:
+    """Encodes a 2D boolean mask as a base64 string of a 1-bit PNG for transport over JSON."""
+    ok, buf = cv2.imencode(".png", mask.astype(np.uint8) * 255, [cv2.IMWRITE_PNG_BILEVEL, 1])
+    if not ok:
+        raise ValueError("Could not encode mask as PNG.")
+    return base64.b64encode(buf.tobytes()).decode("ascii")
+
+def cache_mask(mask: np.ndarray) -> str:
+    """Stores a 2D boolean mask in the mask cache and returns its id."""
+    mask_id = uuid.uuid4().hex
+    os.makedirs(MASK_CACHE_DIR, exist_ok=True)
+    # Write to a temporary file and rename it, so other workers never read a partial mask
+    fd, tmp_path = tempfile.mkstemp(dir=MASK_CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, shape=np.array(mask.shape), packed=np.packbits(mask, axis=None))
+        os.replace(tmp_path, os.path.join(MASK_CACHE_DIR, f"{mask_id}.npz"))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    _evict_cached_masks()
+    return mask_id
+
+def _evict_cached_masks():
+    """Removes expired masks, then the oldest ones beyond MASK_CACHE_SIZE."""
+    entries = []
+    for entry in os.scandir(MASK_CACHE_DIR):
+        if entry.name.endswith(".npz"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass # Already removed by another worker
+    entries.sort()
+    expire_before = time.time() - MASK_CACHE_TTL_SECONDS
+    excess = len(entries) - MASK_CACHE_SIZE
+    for i, (mtime, path) in enumerate(entries):
+        if i >= excess and mtime >= expire_before:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def get_cached_mask(mask_id: str):
+    """
+    Looks up a mask stored by cache_mask.
+
+    Returns:
+        np.ndarray | None: The 2D boolean mask, or None if the id is unknown or has expired.
+    """
+    if not _MASK_ID_RE.fullmatch(mask_id):
+        return None
+    path = os.path.join(MASK_CACHE_DIR, f"{mask_id}.npz")
+    try:
+        if os.path.getmtime(path) < time.time() - MASK_CACHE_TTL_SECONDS:
+            os.remove(path)
+            return None
+        with np.load(path) as data:
+            shape, packed = tuple(data["shape"]), data["packed"]
+    except FileNotFoundError:
+        return None
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+def _set_image_cached(image_path: str) -> bool:
+    """
+    Sets the image on the global SAM_PREDICTOR, reusing a cached embedding when available.
+
+    Returns:
+        bool: True if the predictor holds the image embedding, False if the image could not be read.
+    """
+    cache_key = (os.path.abspath(image_path), os.path.getmtime(image_path))
+    cached = _EMBED_CACHE.get(cache_key)
+    if cached is not None:
+        _EMBED_CACHE.move_to_end(cache_key)
+        print("Reusing cached image embedding.")
+        SAM_PREDICTOR.features, SAM_PREDICTOR.original_size, SAM_PREDICTOR.input_size = cached
+        SAM_PREDICTOR.is_image_set = True
+        return True
+
+    # Read the image using OpenCV
+    image_bgr = cv2.imread(image_path)
+    if image_bgr is None:
+        print(f"Error: Could not read image from path: {image_path}")
+        return False
+    # Convert the image from BGR (OpenCV default) to RGB (SAM expected format)
+    image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+
+    # Set the image for the SAM predictor
+    # This preprocesses the image and stores its embedding.
+    print("Setting image in SAM predictor...")
+    with _encoder_autocast():
+        SAM_PREDICTOR.set_image(image_rgb)
+    # The mask decoder runs in FP32, so hand it FP32 features. Always copy: with CUDA graphs
+    # (torch.compile "reduce-overhead") the encoder output buffer is reused by the next call,
+    # which would silently overwrite embeddings held in _EMBED_CACHE.
+    SAM_PREDICTOR.features = SAM_PREDICTOR.features.to(torch.float32, copy=True)
+    print("Image set successfully.")
+
+    _EMBED_CACHE[cache_key] = (SAM_PREDICTOR.features, SAM_PREDICTOR.original_size, SAM_PREDICTOR.input_size)
+    while len(_EMBED_CACHE) > EMBED_CACHE_SIZE:
+        _EMBED_CACHE.popitem(last=False)
+    return True
+
+def _run_sam(image_path: str, input_points: np.ndarray, input_labels: np.ndarray) -> list:
+    """Blocking part of get_image_segmentation_masks; must be run on _SAM_EXECUTOR."""
+    # Nothing here needs autograd, so run it under inference_mode to skip version counters
+    # and view tracking.
+    with torch.inference_mode():
+        # Set the image for the SAM predictor, skipping the image encoder if this image
+        # has been embedded before.
+        if not _set_image_cached(image_path):
+            return []
+
+        # All prompt sets share the same image embedding, so they are decoded as one batch.
+        # Points are mapped from original image coordinates to SAM's resized input frame.
+        coords_torch = torch.as_tensor(input_points, dtype=torch.float, device=DEVICE)
+        coords_torch = SAM_PREDICTOR.transform.apply_coords_torch(coords_torch, SAM_PREDICTOR.original_size)
+        labels_torch = torch.as_tensor(input_labels, dtype=torch.int, device=DEVICE)
+
+        # Make predictions using SAM
+        # multimask_output=True means SAM will return 3 plausible masks per prompt set.
+        # Only the highest-scoring one per object is sent back to the client.
+        print(f"Predicting masks for {len(input_points)} object(s) with points: {input_points.tolist()}, labels: {input_labels.tolist()}")
+        masks, scores, logits = SAM_PREDICTOR.predict_torch(
+            point_coords=coords_torch,
+            point_labels=labels_torch,
+            multimask_output=True,
+        )
+        best = scores.argmax(dim=-1)
+        batch_index = torch.arange(len(best), device=best.device)
+        best_masks = masks[batch_index, best].cpu().numpy()
+        best_scores = scores[batch_index, best].cpu().numpy()
+    print(f"Generated {len(best_masks)} masks with scores: {best_scores}")
+
+    # `best_masks` is a NumPy array of shape (num_objects, height, width)
+    # Serializing it with tolist() would produce millions of "true"/"false" tokens, so each
+    # mask is sent as a compact PNG instead. The client decodes it to draw on its canvas,
+    # and refers to the server-side copy by id when recoloring.
+    return [
+        {"id": cache_mask(mask), "score": float(score), "mask": encode_mask(mask)}
+        for mask, score in zip(best_masks, best_scores)
+    ]
+
+async def get_image_segmentation_masks(image_path: str, point_coords: list[list[list[float]]], point_labels: list[list[int]]):
+    """
+    Generates one segmentation mask per object for an image given point prompts.
 
     Args:
         image_path (str): The path to the uploaded image.
-        point_coords (list[list[float]]): A list of [x, y] coordinates for point prompts.
-        point_labels (list[int]): A list of labels for the point prompts (1 for foreground, 0 for background).
+        point_coords (list[list[list[float]]]): One list of [x, y] coordinates per object to segment.
+        point_labels (list[list[int]]): One list of labels per object (1 for foreground, 0 for background),
+                                        matching point_coords.
 
     Returns:
-        list: A list of masks. Each mask is a 2D numpy array where True indicates the segmented region.
+        list: The best mask for each object, in the same order as the prompt sets, as dicts with:
+              - "id": the mask's id in the mask cache (see get_cached_mask)
+              - "score": SAM's predicted IoU for the mask
+              - "mask": the mask as a base64-encoded 1-bit PNG (see encode_mask) where white
+                indicates the segmented region
               Returns an empty list if SAM is not loaded or an error occurs.
     """
     if SAM_PREDICTOR is None:
@@ -60,40 +343,19 @@ async def get_image_segmentation_masks(image_path: str, point_coords: list[list[
         return [] # Or raise an exception
 
     try:
-        # Read the image using OpenCV
-        image_bgr = cv2.imread(image_path)
-        if image_bgr is None:
-            print(f"Error: Could not read image from path: {image_path}")
-            return []
-        # Convert the image from BGR (OpenCV default) to RGB (SAM expected format)
-        image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-
-        # Set the image for the SAM predictor
-        # This preprocesses the image and stores its embedding.
-        print("Setting image in SAM predictor...")
-        SAM_PREDICTOR.set_image(image_rgb)
-        print("Image set successfully.")
-
-        # Transform point_coords and point_labels into numpy arrays
-        input_points = np.array(point_coords, dtype=np.float32)
-        input_labels = np.array(point_labels, dtype=np.int32)
+        # Stack the prompt sets into (num_objects, max_points, 2) / (num_objects, max_points)
+        # numpy arrays. Shorter sets are padded with label -1, which SAM ignores as "not a point".
+        max_points = max(len(coords) for coords in point_coords)
+        input_points = np.zeros((len(point_coords), max_points, 2), dtype=np.float32)
+        input_labels = np.full((len(point_labels), max_points), -1, dtype=np.int32)
+        for i, (coords, labels) in enumerate(zip(point_coords, point_labels)):
+            input_points[i, :len(coords)] = coords
+            input_labels[i, :len(labels)] = labels
 
-        # Make predictions using SAM
-        # multimask_output=True means SAM will return multiple plausible masks for a single prompt.
-        # We typically want the "best" one or to let the user choose.
-        # For interactive clicking, usually one good mask is desired.
-        print(f"Predicting masks with points: {input_points}, labels: {input_labels}")
-        masks, scores, logits = SAM_PREDICTOR.predict(
-            point_coords=input_points,
-            point_labels=input_labels,
-            multimask_output=True,  # Set to False if you only want the single best mask
-        )
-        print(f"Generated {len(masks)} masks with scores: {scores}")
-        
-        # `masks` is a NumPy array of shape (num_masks, height, width)
-        # We will return the masks as a list of boolean NumPy arrays.
-        # The client will need to know how to handle these (e.g., convert to polygons, draw on canvas).
-        return masks.tolist() # Convert boolean arrays to lists of lists of booleans for JSON serialization
+        # SAM runs blocking torch calls, so run it on the SAM thread to keep the event loop
+        # free for other requests (uploads, health checks) in the meantime.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_SAM_EXECUTOR, _run_sam, image_path, input_points, input_labels)
 
     except Exception as e:
         print(f"Error during SAM prediction: {e}")
@@ -103,7 +365,8 @@ async def get_image_segmentation_masks(image_path: str, point_coords: list[list[
 
 # Example usage (for testing this file directly, not part of the API yet):
 if __name__ == "__main__":
-    # This block is for testing the service directly.
+    # This block is for testing the service directly. It imports app.core, so run it as a module
+    # from the 'backend' directory: python -m app.services.segmentation_service
     # You would need an image in ../../uploaded_images/ for this to work.
     print("Directly testing segmentation_service.py...")
     load_sam_model() # Load the model
@@ -128,8 +391,8 @@ if __name__ == "__main__":
         # Example point: center of the dummy image, or a point on your actual test_gunpla.png
         # For the dummy image, (50,50) is the center of the white circle.
         # Coordinates are (x, y) from top-left.
-        example_point_coords = [[50.0, 50.0]] 
-        example_point_labels = [1] # 1 means foreground point
+        example_point_coords = [[[50.0, 50.0]]] # A single object prompted by a single point
+        example_point_labels = [[1]] # 1 means foreground point
 
         print(f"Running segmentation on {test_image_path} with point: {example_point_coords}")
         # Run segmentation
@@ -5,9 +5,10 @@ import axios from 'axios';
 
 interface Mask {
   // The structure of a mask will depend on what SAM actually returns and how we process it.
-  // For now, let's assume it might be a 2D array of booleans or numbers.
-  // We will receive it as a list of lists of booleans from the backend.
-  segmentation: boolean[][]; // Raw mask data
+  // We receive it from the backend as a base64-encoded 1-bit PNG and decode it to a 2D array of booleans.
+  segmentation: boolean[][]; // Decoded mask data, used for drawing and area/bbox calculation
+  serverMaskId: string; // Id of the backend's copy of this mask, sent when recoloring
+  score: number; // SAM's predicted IoU for this mask
   bbox: { x: number; y: number; width: number; height: number }; // Calculated BBox
   area: number;
   id: string; // Changed to string for robust unique IDs (e.g., UUID or timestamp-based)
@@ -22,14 +23,48 @@ interface PointPrompt {
   id: string; // For unique key in React list
 }
 
+// Image types the backend accepts (ALLOWED_UPLOAD_CONTENT_TYPES in backend/app/main.py)
+const ACCEPTED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/webp', 'image/bmp', 'image/tiff'];
+
 let maskIdCounter = 0; // Simple counter for unique mask IDs across multiple segmentations
 let pointIdCounter = 0;
 
+// Decodes a base64 PNG mask from the backend into a 2D boolean array (true where the pixel is white).
+const decodeMaskPng = (encodedMask: string): Promise<boolean[][]> => new Promise((resolve, reject) => {
+  const img = new Image();
+  img.onload = () => {
+    const canvas = document.createElement('canvas');
+    canvas.width = img.naturalWidth;
+    canvas.height = img.naturalHeight;
+    const ctx = canvas.getContext('2d');
+    if (!ctx) {
+      reject(new Error('Could not create canvas context to decode mask.'));
+      return;
+    }
+    ctx.drawImage(img, 0, 0);
+    const { data, width, height } = ctx.getImageData(0, 0, canvas.width, canvas.height);
+    const rows: boolean[][] = [];
+    for (let r = 0; r < height; r++) {
+      const row: boolean[] = new Array(width);
+      for (let c = 0; c < width; c++) {
+        row[c] = data[(r * width + c) * 4] > 127;
+      }
+      rows.push(row);
+    }
+    resolve(rows);
+  };
+  img.onerror = () => reject(new Error('Could not decode mask PNG.'));
+  img.src = `data:image/png;base64,${encodedMask}`;
+});
+
 export default function HomePage() {
   const [selectedImageFile, setSelectedImageFile] = useState<File | null>(null);
   const [previewUrl, setPreviewUrl] = useState<string | null>(null);
   const [uploadedImageName, setUploadedImageName] = useState<string | null>(null);
   const [uploadedImageUrl, setUploadedImageUrl] = useState<string | null>(null);
+  // The backend writes recolors to 'recolored_images/<upload>_<hex>.png', replacing earlier results; this is the latest one (null until the first recolor).
+  // Segmentation keeps using the original upload, recoloring builds on the latest result.
+  const [recoloredImageName, setRecoloredImageName] = useState<string | null>(null);
 
   const [isLoading, setIsLoading] = useState<boolean>(false);
   const [isSegmenting, setIsSegmenting] = useState<boolean>(false);
@@ -52,6 +87,7 @@ export default function HomePage() {
   const resetImageState = () => {
     setUploadedImageUrl(null);
     setUploadedImageName(null);
+    setRecoloredImageName(null);
     setCurrentPromptGroupId(null); // Reset group ID
     setStagingMasks([]); 
     setSegmentedMasks([]);
@@ -97,13 +133,13 @@ export default function HomePage() {
     event.stopPropagation();
     if (event.dataTransfer.files && event.dataTransfer.files[0]) {
       const file = event.dataTransfer.files[0];
-      if (file.type.startsWith('image/')) {
+      if (ACCEPTED_IMAGE_TYPES.includes(file.type)) {
         setSelectedImageFile(file);
         if (previewUrl) URL.revokeObjectURL(previewUrl); // Revoke old blob URL for small preview
         setPreviewUrl(URL.createObjectURL(file)); // Set new blob URL for small preview
         resetImageState();
       } else {
-        setError('Invalid file type. Please upload an image.');
+        setError('Invalid file type. Please upload a JPG, PNG, WEBP, BMP or TIFF image.');
       }
     }
   };
@@ -137,6 +173,7 @@ export default function HomePage() {
     // Reset relevant states before new upload, but keep selectedFile and its previewUrl
     setUploadedImageUrl(null);
     setUploadedImageName(null);
+    setRecoloredImageName(null);
     setStagingMasks([]);
     setSegmentedMasks([]);
     setCurrentPrompts([]);
@@ -174,6 +211,7 @@ export default function HomePage() {
       handleApiError(err, 'upload');
       setUploadedImageUrl(null); // Clear if upload failed
       setUploadedImageName(null);
+      setRecoloredImageName(null);
     } finally {
       setIsLoading(false);
     }
@@ -269,11 +307,12 @@ export default function HomePage() {
     try {
       const segmentationResponse = await axios.post('http://localhost:8000/segment-image/', {
         image_name: uploadedImageName,
-        prompts: pointsForApi 
+        prompts: [pointsForApi] // The current points all describe a single object
       });
-      const rawMasks = segmentationResponse.data.masks; 
+      const rawMasks: { id: string; score: number; mask: string }[] = segmentationResponse.data.masks; 
       if (rawMasks && rawMasks.length > 0) {
-        const newProcessedMasks: Mask[] = rawMasks.map((maskData: boolean[][], index: number) => {
+        const decodedMasks = await Promise.all(rawMasks.map(rawMask => decodeMaskPng(rawMask.mask)));
+        const newProcessedMasks: Mask[] = decodedMasks.map((maskData: boolean[][], index: number) => {
           let minX = Infinity, minY = Infinity, maxX = -1, maxY = -1; let area = 0;
           maskData.forEach((row, rIndex) => {
             row.forEach((pixel, cIndex) => {
@@ -290,6 +329,8 @@ export default function HomePage() {
             id: `mask-${Date.now()}-${maskIdCounter}`,
             promptGroupId: newPromptGroupId, // Assign group ID from the state
             segmentation: maskData, 
+            serverMaskId: rawMasks[index].id,
+            score: rawMasks[index].score,
             bbox: bbox, 
             area: area, 
             // Do not assign selectedColor here, staging masks are neutral until selected/colored
@@ -465,7 +506,8 @@ export default function HomePage() {
     try {
       const response = await axios.post('http://localhost:8000/recolor-image/', {
         image_name: uploadedImageName,
-        mask: maskToRecolor.segmentation, // Send the raw boolean mask data
+        recolored_image_name: recoloredImageName, // Apply on top of earlier recolors
+        mask_id: maskToRecolor.serverMaskId, // The backend keeps the mask itself; just reference it
         target_hex_color: selectedColor,
       });
 
@@ -476,12 +518,14 @@ export default function HomePage() {
         prevMasks.map(m => m.id === maskId ? {...m, color: selectedColor} : m)
       );
 
-      // Force a reload of the displayed image from the server to show the backend changes
-      // uploadedImageUrl should now be the direct server URL
-      if (uploadedImageUrl) { 
-        const baseUrl = uploadedImageUrl.split('?')[0];
-        setUploadedImageUrl(`${baseUrl}?t=${new Date().getTime()}`);
-        console.log("Refreshing image from server:", `${baseUrl}?t=${new Date().getTime()}`);
+      // Display the new recolored file from the server; the original upload is left untouched
+      // (null if nothing changed and there is no earlier result, so keep showing the upload)
+      const newImageName = response.data.recolored_image_name;
+      if (newImageName) {
+        setRecoloredImageName(newImageName);
+        const newImageUrl = `http://localhost:8000/recolored_images/${newImageName}?t=${new Date().getTime()}`;
+        setUploadedImageUrl(newImageUrl);
+        console.log("Showing recolored image from server:", newImageUrl);
       }
       setError(null); // Clear any previous errors
 
@@ -573,7 +617,7 @@ export default function HomePage() {
               <input 
                 type="file" 
                 id="fileInput"
-                accept="image/*" 
+                accept={ACCEPTED_IMAGE_TYPES.join(',')} 
                 onChange={handleFileChange} 
                 className="hidden" 
               />
@@ -585,7 +629,7 @@ export default function HomePage() {
                     <path strokeLinecap="round" strokeLinejoin="round" d="M4 16l4.586-4.586a2 2 0 012.828 0L16 16m-2-2l1.586-1.586a2 2 0 012.828 0L20 14m-6-6h.01M6 20h12a2 2 0 002-2V6a2 2 0 00-2-2H6a2 2 0 00-2 2v12a2 2 0 002 2z" />
                   </svg>
                   <p>Drag & drop image or click</p>
-                  <p className="text-xs md:text-sm">Supports JPG, PNG, WEBP</p>
+                  <p className="text-xs md:text-sm">Supports JPG, PNG, WEBP, BMP, TIFF</p>
                 </div>
               )}
             </div>
@@ -705,7 +749,7 @@ export default function HomePage() {
                     if (!uploadedImageUrl || !uploadedImageName) return;
                     const link = document.createElement('a');
                     link.href = uploadedImageUrl.split('?')[0]; // Use base URL without cache-buster
-                    link.download = uploadedImageName; // Use the current image name for download
+                    link.download = recoloredImageName || uploadedImageName; // Use the current image name for download
                     document.body.appendChild(link);
                     link.click();
                     document.body.removeChild(link);